@@ -28,6 +28,7 @@ DECODER_PATH = "decoder.json"
 SAVEDIR = "data_chorales"
 ONE_FILE_PATH = "choral_data.txt"
 SEQUENCE_LENGTH = 64
+VOICES = 4                      # soprano, alto, tenor, bass
 
 
 def has_acceptable_durations(song, acceptable_durations):
@@ -36,7 +37,8 @@ def has_acceptable_durations(song, acceptable_durations):
 
         PARAMETERS
         ----------------
-        song :                    Piece to check for durations as music21 stream
+        song :                    Piece to check for durations as music21 stream or
+                                  list of events as returned by extract_events
         acceptable_durations :    List of acceptable duration in quarter length
 
         RETURNS:
@@ -44,15 +46,111 @@ def has_acceptable_durations(song, acceptable_durations):
         boolean
 
     """
-    for note in song.flat.notesAndRests:
-        if note.duration.quarterLength not in acceptable_durations:
-            return False
-    return True
+    if isinstance(song, m21.stream.Stream):
+        song = extract_events(song)
+    durations = np.concatenate([part_durations for _, part_durations, _ in song])
+    return bool(np.isin(durations, acceptable_durations).all())
 
 
-def transpose(song):
+def extract_events(song):
     """
-        Transposes song to C maj/A min
+        Walks every part of the score exactly once and collects offsets, durations
+        and pitches of all notes and rests. Rests are stored as None.
+
+        PARAMETERS
+        ----------------
+        song :   Piece as music21 stream
+
+        RETURNS:
+        ----------------
+        list with one tuple (offsets, durations, pitches) per part, where offsets and
+        durations are float numpy arrays in quarter length and pitches is a list of
+        music21 pitches
+
+    """
+    events = []
+    for part in song.parts:
+        offsets, durations, pitches = [], [], []
+        for event in part.flatten().notesAndRests:
+            if isinstance(event, m21.note.Note):
+                pitches.append(event.pitch)
+            elif isinstance(event, m21.note.Rest):
+                pitches.append(None)
+            else:
+                raise ValueError(f"Unsupported event {event!r} in part {part.id}")
+            offsets.append(float(event.offset))
+            durations.append(float(event.duration.quarterLength))
+        events.append((np.asarray(offsets), np.asarray(durations), pitches))
+    return events
+
+
+def quantize(values, time_step, tolerance=1e-6):
+    """
+        Maps offsets or durations onto a grid of width time_step. Use 0.25 for the
+        16th grid, 0.5 for 8ths and 1/3 (or 1/12 together with 16ths) for triplets.
+
+        PARAMETERS
+        ----------------
+        values :        numpy array of quarter lengths
+        time_step :     width of the grid in quarter length
+        tolerance :     allowed deviation from the grid in steps
+
+        RETURNS:
+        ----------------
+        numpy int array with the number of steps
+
+    """
+    steps = np.asarray(values, dtype=float) / time_step
+    rounded = np.rint(steps)
+    off_grid = np.abs(steps - rounded) > tolerance
+    if off_grid.any():
+        raise ValueError(f"{int(off_grid.sum())} values do not fit a grid of {time_step} quarter lengths")
+    return rounded.astype(int)
+
+
+def events_to_grid(events, time_step=0.25, symbol=lambda pitch: pitch.midi):
+    """
+        Writes the extracted events of the four voices into a (time steps, 4) matrix.
+        Every cell holds the symbol of the pitch starting at that step, 'r' for a rest
+        starting there and '_' for notes/rests that are carried over.
+
+        PARAMETERS
+        ----------------
+        events :        list of (offsets, durations, pitches) as returned by extract_events
+        time_step :     duration of each time step in quarter length
+        symbol :        function that maps a music21 pitch onto its symbol
+
+        RETURNS:
+        ----------------
+        numpy object array of shape (T, 4)
+
+    """
+    if len(events) != VOICES:
+        raise ValueError(f"Expected {VOICES} voices, got {len(events)}")
+    quantized = []
+    for j, (offsets, durations, pitches) in enumerate(events):
+        starts = quantize(offsets, time_step)
+        lengths = quantize(durations, time_step)
+        if (lengths < 1).any():
+            raise ValueError(f"Voice {j} has events shorter than one time step")
+        ends = starts + lengths
+        if len(starts) and (starts[0] != 0 or (starts[1:] != ends[:-1]).any()):
+            raise ValueError(f"Voice {j} has gaps or overlapping events")
+        quantized.append((starts, ends[-1] if len(ends) else 0, pitches))
+
+    lengths = {end for _, end, _ in quantized}
+    if len(lengths) != 1:
+        raise ValueError(f"Voices differ in length: {[end for _, end, _ in quantized]} steps")
+
+    grid = np.full((lengths.pop(), len(events)), "_", dtype=object)
+    for j, (starts, _, pitches) in enumerate(quantized):
+        grid[starts, j] = ["r" if pitch is None else symbol(pitch) for pitch in pitches]
+    return grid
+
+
+def transposition_interval(song):
+    """
+        Computes the interval which transposes song to C maj/A min
 
         PARAMETERS:
         ----------------
@@ -60,13 +158,12 @@ def transpose(song):
 
         RETURNS:
         ----------------
-        transposed song (as music21 stream)
+        music21 interval
 
     """
-    try:
-        key = song.parts[0].flat.getElementsByClass(m21.key.Key)[0]
-    except:
-        key = song.parts[1].flat.getElementsByClass(m21.key.Key)[0]     # lazy solution, improve later
+    key = song.parts[0].recurse().getElementsByClass(m21.key.Key).first()
+    if key is None:
+        key = song.parts[1].recurse().getElementsByClass(m21.key.Key).first()     # lazy solution, improve later
 
     # estimate key using music21
     if not isinstance(key, m21.key.Key):
@@ -78,12 +175,28 @@ def transpose(song):
     elif key.mode == "minor":
         interval = m21.interval.Interval(key.tonic, m21.pitch.Pitch("A"))
 
-    tranposed_song = song.transpose(interval)
+    return interval
+
+
+def transpose(song):
+    """
+        Transposes song to C maj/A min
+
+        PARAMETERS:
+        ----------------
+        song :   Piece to transpose
+
+        RETURNS:
+        ----------------
+        transposed song (as music21 stream)
+
+    """
+    tranposed_song = song.transpose(transposition_interval(song))
 
     return tranposed_song
 
 
-def encode_song(song, savedir, song_filename, time_step=0.25):
+def encode_song(song, savedir, song_filename, time_step=0.25, interval=None):
     """
         Converts a score into a time-series-like music representation. Each item in 
         the encoded list represents 'min_duration' quarter lengths. The symbols used at 
@@ -93,26 +206,20 @@ def encode_song(song, savedir, song_filename, time_step=0.25):
 
         PARAMETERS:
         -------------
-        song :              Piece to encode (m21 stream)
+        song :              Piece to encode (m21 stream or events from extract_events)
         savedir :           Directory where the encoded song should be saved
         song_filename :     Name of file
         time_step :         Duration of each time step in quarter length
+        interval :          Optional music21 interval applied to every pitch
 
     """
-    encoded_song = []
-    for part in song.parts:
-        encoded_part = []
-        for event in part.flat.notesAndRests:            
-            steps = ["_"] * (int(event.duration.quarterLength / time_step) - 1)
-            if isinstance(event, m21.note.Note):
-                symbol = event.pitch.midi
-            if isinstance(event, m21.note.Rest):
-                symbol = "r"
-            
-            encoded_part.append(symbol)
-            encoded_part.extend(steps)
-        encoded_song.append(encoded_part)
-    encoded_text = "\n".join([" ".join(map(str, part)) for part in encoded_song])
+    if isinstance(song, m21.stream.Stream):
+        song = extract_events(song)
+    if interval is None:
+        grid = events_to_grid(song, time_step)
+    else:
+        grid = events_to_grid(song, time_step, symbol=lambda pitch: interval.transposePitch(pitch).midi)
+    encoded_text = "\n".join([" ".join(map(str, part)) for part in grid.T])
 
     with open(os.path.join(savedir, song_filename), "w") as fp:
         fp.write(encoded_text)
@@ -248,29 +355,36 @@ def generate_training_sequences(sequence_length):
     return inputs, targets
 
 
-def preprocess(songs, durations, save_dir):
+def preprocess(songs, durations, save_dir, time_step=0.25):
     """
         Creates a directory and saves all preprocessed songs
         into that folder. The songs are checked if they have 
         notes of acceptable length since we only consider 
         notes which match to a 16th note grid.
         All pieces are transposed to C Major or A Minor.
+        Every score is traversed only once, the transposition is applied
+        to the extracted pitches instead of the whole stream.
 
         PARAMETERS:
         ----------------
         songs :     songs to preprocess. In this case the Bach chorales
-        durations:  acceptable durations
+        durations:  acceptable durations, None to accept every duration which
+                    fits the grid of time_step (e.g. 1/3 for triplets)
         save_dir :  path to directory (created only if not exists)
+        time_step : duration of each time step in quarter length
         
     """
     if not os.path.exists(save_dir):
         os.makedirs(save_dir)
 
     for i, song in enumerate(songs):
-        if not has_acceptable_durations(song, durations):
-            continue
-        song = transpose(song)
-        encode_song(song, save_dir, str(i)+".txt")
+        try:
+            events = extract_events(song)
+            if durations is not None and not has_acceptable_durations(events, durations):
+                continue
+            encode_song(events, save_dir, str(i)+".txt", time_step, interval=transposition_interval(song))
+        except ValueError as e:
+            print(f"Skipping song {i}: {e}")
 
 
 if __name__=="__main__":
@@ -1,9 +1,9 @@
 import music21 as m21
-import numpy as np
 import jsonlines
 import os
 from data_preprocessing import BACH_CHORALES, ACCEPTABLE_DURATIONS,\
-                               has_acceptable_durations, transpose
+                               has_acceptable_durations, transposition_interval,\
+                               extract_events, events_to_grid
 
 
 SAVEDIR = "data_chorales_gpt3"
@@ -11,7 +11,7 @@ ONE_FILE_PATH = "choral_data_gpt3.txt"
 SEQUENCE_LENGTH = 128
 
 
-def encode_song(song, savedir, song_filename, time_step=0.25):
+def encode_song(song, savedir, song_filename, time_step=0.25, interval=None):
     """
         Converts a score into a time-series-like music representation. Each item in 
         the encoded list represents 'min_duration' quarter lengths. The symbols used at 
@@ -25,28 +25,20 @@ def encode_song(song, savedir, song_filename, time_step=0.25):
 
         PARAMETERS:
         -------------
-        song :              Piece to encode (m21 stream)
+        song :              Piece to encode (m21 stream or events from extract_events)
         savedir :           Directory where the encoded song should be saved
         song_filename :     Name of file
         time_step :         Duration of each time step in quarter length
+        interval :          Optional music21 interval applied to every pitch
 
     """
-    encoded_song = []
-    for part in song.parts:
-        encoded_part = []
-        for event in part.flat.notesAndRests:            
-            steps = ["_"] * (int(event.duration.quarterLength / time_step) - 1)
-            if isinstance(event, m21.note.Note):
-                symbol = str(event.pitch)
-            if isinstance(event, m21.note.Rest):
-                symbol = "r"
-            
-            encoded_part.append(symbol)
-            encoded_part.extend(steps)
-        encoded_song.append(encoded_part)
-
-    transposed = np.array(encoded_song).T.tolist()
-    encoded_text = "\n".join([" ".join(map(str, part)) for part in transposed])
+    if isinstance(song, m21.stream.Stream):
+        song = extract_events(song)
+    if interval is None:
+        grid = events_to_grid(song, time_step, symbol=str)
+    else:
+        grid = events_to_grid(song, time_step, symbol=lambda pitch: str(interval.transposePitch(pitch)))
+    encoded_text = "\n".join([" ".join(map(str, line)) for line in grid])
 
     with open(os.path.join(savedir, song_filename), "w") as fp:
         fp.write(encoded_text)
@@ -86,7 +78,7 @@ def create_single_file(data_path, sequence_length):
                 fp.write(delimiter)    
 
 
-def preprocess(songs, durations, save_dir):
+def preprocess(songs, durations, save_dir, time_step=0.25):
     """
         Creates a directory and saves all preprocessed songs
         into that folder. The songs are checked if they have 
@@ -97,18 +89,23 @@ def preprocess(songs, durations, save_dir):
         PARAMETERS:
         ----------------
         songs :     songs to preprocess. In this case the Bach chorales
-        durations:  acceptable durations
+        durations:  acceptable durations, None to accept every duration which
+                    fits the grid of time_step (e.g. 1/3 for triplets)
         save_dir :  path to directory (created only if not exists)
+        time_step : duration of each time step in quarter length
         
     """
     if not os.path.exists(save_dir):
         os.makedirs(save_dir)
 
     for i, song in enumerate(songs):
-        if not has_acceptable_durations(song, durations):
-            continue
-        song = transpose(song)
-        encode_song(song, save_dir, str(i)+".txt")
+        try:
+            events = extract_events(song)
+            if durations is not None and not has_acceptable_durations(events, durations):
+                continue
+            encode_song(events, save_dir, str(i)+".txt", time_step, interval=transposition_interval(song))
+        except ValueError as e:
+            print(f"Skipping song {i}: {e}")
 
 
 def generate_training_sequences_empty(data_path):
@@ -0,0 +1,369 @@
+"""
+    This module evaluates generated chorales automatically. It works on the same
+    text representation as save_piece (one line per 16th step, four symbols per line
+    from soprano to bass) and computes all statistics with numpy on a whole batch of
+    pieces at once:
+
+        * parallel fifths and octaves between every pair of voices
+        * voice crossings between neighbouring voices
+        * notes outside the usual range of each voice
+        * hold/rest statistics
+        * pitch-class and melodic interval histograms, compared with the corpus
+          in data_chorales_gpt3 via the Jensen-Shannon divergence
+
+    The summary is written as a json report, so different models or temperatures
+    can be compared offline.
+
+"""
+import numpy as np
+import json
+import os
+import sys
+from functools import lru_cache
+
+PATH_TO_CHORALES = "data_chorales_gpt3"
+PATH_TO_GENERATED = "generated_chorales"
+REPORT_PATH = "evaluation_report.json"
+
+VOICE_RANGES = np.array([[59, 81], [53, 76], [45, 69], [36, 64]])    # MIDI, lowest and highest note
+MAX_INTERVAL = 12               # melodic intervals are clipped to +- one octave
+
+HOLD = -1
+REST = -2
+PAD = -3
+
+NOTE_NAMES = {"C": 0, "D": 2, "E": 4, "F": 5, "G": 7, "A": 9, "B": 11}
+ACCIDENTALS = {"": 0, "#": 1, "##": 2, "-": -1, "--": -2}
+
+
+@lru_cache(maxsize=None)
+def symbol_to_midi(symbol):
+    """
+        Maps one symbol of the text representation onto an integer code.
+
+        PARAMETERS:
+        ---------------
+        symbol :    e.g. "C#4", "B-3", "r" or "_"
+
+        RETURNS:
+        ---------------
+        MIDI number of the pitch, HOLD for "_" and REST for "r" and unknown symbols
+
+    """
+    if symbol == "_":
+        return HOLD
+    if symbol == "r" or symbol[:1] not in NOTE_NAMES:
+        return REST
+    octave_start = 1
+    while octave_start < len(symbol) and symbol[octave_start] in "#-":
+        octave_start += 1
+    accidental = symbol[1:octave_start]
+    try:
+        octave = int(symbol[octave_start:])
+    except ValueError:
+        return REST
+    if accidental not in ACCIDENTALS:
+        return REST
+    return 12 * (octave + 1) + NOTE_NAMES[symbol[0]] + ACCIDENTALS[accidental]
+
+
+def parse_piece(piece):
+    """
+        Converts the text representation of one piece into a (T, 4) int array.
+        Lines which do not contain exactly four symbols (e.g. the unfinished last
+        line of a completion) are dropped.
+
+        PARAMETERS:
+        ---------------
+        piece :     string representation of the piece
+
+        RETURNS:
+        ---------------
+        np.array of shape (T, 4) with the codes of symbol_to_midi
+
+    """
+    rows = (line.split() for line in piece.split("\n"))
+    symbols = [symbol for row in rows if len(row) == 4 for symbol in row]
+    return np.fromiter(map(symbol_to_midi, symbols), dtype=np.int16, count=len(symbols)).reshape(-1, 4)
+
+
+def stack_pieces(pieces):
+    """
+        Parses and pads a list of pieces into one batch.
+
+        PARAMETERS:
+        ---------------
+        pieces :    list of string representations
+
+        RETURNS:
+        ---------------
+        np.array of shape (number of pieces, T_max, 4), padded with PAD
+
+    """
+    grids = [parse_piece(piece) for piece in pieces]
+    length = max([len(grid) for grid in grids], default=0)
+    batch = np.full((len(grids), length, 4), PAD, dtype=np.int16)
+    for i, grid in enumerate(grids):
+        batch[i, :len(grid)] = grid
+    return batch
+
+
+def sounding_pitches(batch):
+    """
+        Replaces every held step by the pitch which is sounding at that step.
+
+        PARAMETERS:
+        ---------------
+        batch :     (N, T, 4) array as returned by stack_pieces
+
+        RETURNS:
+        ---------------
+        (N, T, 4) array with MIDI numbers and -1 where nothing is sounding
+
+    """
+    steps = np.arange(batch.shape[1])[None, :, None]
+    last_onset = np.maximum.accumulate(np.where(batch != HOLD, steps, 0), axis=1)
+    pitches = np.take_along_axis(batch, last_onset, axis=1).astype(np.int16)
+    pitches[pitches < 0] = -1
+    return pitches
+
+
+def histogram(values, mask, bins):
+    """
+        Row-wise normalized histogram of the integers in values[mask], values in [0, bins).
+
+        PARAMETERS:
+        ---------------
+        values :    (N, ...) int array
+        mask :      boolean array of the same shape
+        bins :      number of bins
+
+        RETURNS:
+        ---------------
+        (N, bins) array, rows sum up to 1 (or 0 if there was no value)
+
+    """
+    rows = np.broadcast_to(np.arange(len(values)).reshape((-1,) + (1,) * (values.ndim - 1)), values.shape)
+    counts = np.bincount(rows[mask] * bins + values[mask], minlength=len(values) * bins)
+    counts = counts.reshape(len(values), bins).astype(float)
+    totals = counts.sum(axis=1, keepdims=True)
+    return np.divide(counts, totals, out=np.zeros_like(counts), where=totals > 0)
+
+
+def js_divergence(p, q):
+    """
+        Jensen-Shannon divergence (base 2) between distributions.
+
+        PARAMETERS:
+        ---------------
+        p :     (N, bins) array, one distribution per row
+        q :     (bins,) array, the reference distribution
+
+        RETURNS:
+        ---------------
+        np.array of N divergences between 0 and 1
+
+    """
+    m = (p + q) / 2
+
+    def kl(a, b):
+        return np.where(a > 0, a * np.log2(np.where(a > 0, a, 1) / np.where(b > 0, b, 1)), 0).sum(axis=-1)
+
+    return (kl(p, m) + kl(q, m)) / 2
+
+
+def evaluate_batch(batch):
+    """
+        Computes all voice-leading statistics for a batch of pieces.
+
+        PARAMETERS:
+        ---------------
+        batch :     (N, T, 4) array as returned by stack_pieces
+
+        RETURNS:
+        ---------------
+        dict with one array of length N for every scalar metric and the
+        histograms "pitch_classes" (N, 12) and "intervals" (N, 2 * MAX_INTERVAL + 1)
+
+    """
+    valid = batch != PAD
+    onsets = batch >= 0
+    pitches = sounding_pitches(batch)
+    sounding = pitches >= 0
+    steps = valid[:, :, 0].sum(axis=1)
+
+    # parallel fifths/octaves: both voices move in the same direction and the interval
+    # class of a perfect fifth or octave/unison is kept between two consecutive steps
+    upper, lower = np.triu_indices(4, k=1)
+    harmonic = pitches[:, :, upper] - pitches[:, :, lower]
+    both = sounding[:, :, upper] & sounding[:, :, lower]
+    moves = np.diff(pitches, axis=1)
+    same_direction = (np.sign(moves[:, :, upper]) == np.sign(moves[:, :, lower])) & (moves[:, :, upper] != 0)
+    kept = both[:, 1:] & both[:, :-1] & same_direction & (harmonic[:, 1:] % 12 == harmonic[:, :-1] % 12)
+    fifths = (kept & (harmonic[:, 1:] % 12 == 7)).sum(axis=(1, 2))
+    octaves = (kept & (harmonic[:, 1:] % 12 == 0)).sum(axis=(1, 2))
+
+    # voice crossings: a lower voice sounds above its upper neighbour
+    neighbours = sounding[:, :, :-1] & sounding[:, :, 1:]
+    crossings = (neighbours & (pitches[:, :, :-1] < pitches[:, :, 1:])).sum(axis=(1, 2))
+
+    # range violations are counted per note, not per step
+    out_of_range = onsets & ((batch < VOICE_RANGES[:, 0]) | (batch > VOICE_RANGES[:, 1]))
+    range_violations = out_of_range.sum(axis=(1, 2))
+
+    notes = onsets.sum(axis=(1, 2))
+    rests = (batch == REST).sum(axis=(1, 2))
+    holds = (batch == HOLD).sum(axis=(1, 2))
+    cells = np.maximum(valid.sum(axis=(1, 2)), 1)
+    note_cells = (sounding & valid).sum(axis=(1, 2))
+
+    # melodic intervals between consecutive notes of the same voice
+    note_steps = np.where(onsets, pitches, -1)
+    order = np.argsort(~onsets, axis=1, kind="stable")
+    sorted_notes = np.take_along_axis(note_steps, order, axis=1)
+    consecutive = (sorted_notes[:, 1:] >= 0) & (sorted_notes[:, :-1] >= 0)
+    intervals = np.clip(np.diff(sorted_notes, axis=1), -MAX_INTERVAL, MAX_INTERVAL) + MAX_INTERVAL
+
+    return {
+        "steps": steps,
+        "parallel_fifths": fifths,
+        "parallel_octaves": octaves,
+        "voice_crossings": crossings,
+        "range_violations": range_violations,
+        "hold_ratio": holds / cells,
+        "rest_ratio": rests / cells,
+        "mean_note_length": note_cells / np.maximum(notes, 1),
+        "pitch_classes": histogram(np.where(onsets, batch, 0) % 12, onsets, 12),
+        "intervals": histogram(intervals, consecutive, 2 * MAX_INTERVAL + 1),
+    }
+
+
+def load_directory(data_path):
+    """
+        Reads all pieces (txt files) in a directory.
+
+        PARAMETERS:
+        ---------------
+        data_path :     path to directory
+
+        RETURNS:
+        ---------------
+        names :     list of file names
+        pieces :    list of string representations
+
+    """
+    names, pieces = [], []
+    for path, _, files in os.walk(data_path):
+        for file in sorted(files):
+            if not file.endswith(".txt"):
+                continue
+            with open(os.path.join(path, file), "r") as fp:
+                pieces.append(fp.read())
+            names.append(file)
+    return names, pieces
+
+
+def reference_histograms(data_path=PATH_TO_CHORALES):
+    """
+        Pitch-class and interval distributions of the whole corpus.
+
+        PARAMETERS:
+        ---------------
+        data_path :     path to the encoded chorales
+
+        RETURNS:
+        ---------------
+        dict with the distributions "pitch_classes" and "intervals"
+
+    """
+    _, pieces = load_directory(data_path)
+    batch = stack_pieces(pieces)
+    metrics = evaluate_batch(batch)
+    notes = (batch >= 0).sum(axis=(1, 2))
+    weights = notes / notes.sum()
+    return {key: weights @ metrics[key] for key in ("pitch_classes", "intervals")}
+
+
+def evaluate(pieces, reference=None):
+    """
+        Evaluates a list of generated pieces and compares them with the corpus.
+
+        PARAMETERS:
+        ---------------
+        pieces :        list of string representations
+        reference :     result of reference_histograms, computed if None
+
+        RETURNS:
+        ---------------
+        dict of per piece metrics, see evaluate_batch, plus the divergences
+        "pitch_class_divergence" and "interval_divergence"
+
+    """
+    if reference is None:
+        reference = reference_histograms()
+    metrics = evaluate_batch(stack_pieces(pieces))
+    metrics["pitch_class_divergence"] = js_divergence(metrics["pitch_classes"], reference["pitch_classes"])
+    metrics["interval_divergence"] = js_divergence(metrics["intervals"], reference["intervals"])
+    return metrics
+
+
+def summarize(metrics, names=None):
+    """
+        Aggregates the per piece metrics into a json serializable report.
+
+        PARAMETERS:
+        ---------------
+        metrics :   result of evaluate
+        names :     optional names of the pieces for the per piece table
+
+        RETURNS:
+        ---------------
+        dict with mean/std/min/max of every scalar metric and the mean histograms
+
+    """
+    scalars = {key: value for key, value in metrics.items() if value.ndim == 1}
+    report = {"pieces": len(metrics["steps"]), "metrics": {}}
+    for key, value in scalars.items():
+        report["metrics"][key] = {
+            "mean": float(value.mean()) if len(value) else 0.0,
+            "std": float(value.std()) if len(value) else 0.0,
+            "min": float(value.min()) if len(value) else 0.0,
+            "max": float(value.max()) if len(value) else 0.0,
+        }
+    pitch_classes, intervals = metrics["pitch_classes"], metrics["intervals"]
+    if len(metrics["steps"]) == 0:
+        pitch_classes, intervals = np.zeros((1, 12)), np.zeros((1, 2 * MAX_INTERVAL + 1))
+    report["pitch_classes"] = pitch_classes.mean(axis=0).round(4).tolist()
+    report["intervals"] = dict(zip(range(-MAX_INTERVAL, MAX_INTERVAL + 1),
+                                   intervals.mean(axis=0).round(4).tolist()))
+    if names is not None:
+        report["per_piece"] = {name: {key: float(value[i]) for key, value in scalars.items()}
+                               for i, name in enumerate(names)}
+    return report
+
+
+def write_report(data_path, report_path=REPORT_PATH):
+    """
+        Evaluates all pieces in a directory and writes the summary to a json file.
+
+        PARAMETERS:
+        ---------------
+        data_path :     directory with generated pieces
+        report_path :   path of the json report
+
+        RETURNS:
+        ---------------
+        report as dict
+
+    """
+    names, pieces = load_directory(data_path)
+    report = summarize(evaluate(pieces), names)
+    with open(report_path, "w") as fp:
+        json.dump(report, fp, indent=4)
+    return report
+
+
+if __name__=="__main__":
+    print("Start evaluation")
+    write_report(sys.argv[1] if len(sys.argv) > 1 else PATH_TO_GENERATED)
+    print("Finished")
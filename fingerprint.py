@@ -0,0 +1,254 @@
+"""
+    This module detects passages of generated pieces which are copied from the
+    training chorales in data_chorales_gpt3.
+
+    Every line (one 16th step of all four voices) is packed into one integer and
+    every window of k consecutive lines is fingerprinted with a polynomial rolling
+    hash. The fingerprints of the whole corpus are stored in one sorted numpy array,
+    so looking up all windows of a generated piece is a single searchsorted call.
+    Near duplicates (e.g. one voice changed) are found with MinHash signatures.
+
+"""
+import numpy as np
+import hashlib
+import os
+import threading
+from evaluation import PATH_TO_CHORALES, PAD, load_directory, parse_piece
+
+WINDOW = 16                     # one bar of 16th steps
+SHINGLE = 4                     # window length for the MinHash shingles
+NUM_PERMUTATIONS = 64
+BASE = np.uint64(1000003)
+INDEX_PATH = "fingerprint_index.npz"
+
+_INDEX = None
+_INDEX_LOCK = threading.Lock()
+
+
+def pack_lines(grid):
+    """
+        Packs every line of a (T, 4) grid into one integer.
+
+        PARAMETERS:
+        ---------------
+        grid :      (T, 4) array as returned by parse_piece
+
+        RETURNS:
+        ---------------
+        np.array of T uint64 values
+
+    """
+    codes = (grid.astype(np.int64) - PAD).astype(np.uint64)
+    return codes[:, 0] << np.uint64(48) | codes[:, 1] << np.uint64(32) | codes[:, 2] << np.uint64(16) | codes[:, 3]
+
+
+def rolling_hashes(lines, window):
+    """
+        Polynomial hash (mod 2**64) of every window of consecutive lines.
+
+        PARAMETERS:
+        ---------------
+        lines :     np.array of packed lines
+        window :    number of lines per window
+
+        RETURNS:
+        ---------------
+        np.array of len(lines) - window + 1 uint64 hashes (empty if the piece is shorter)
+
+    """
+    count = len(lines) - window + 1
+    if count <= 0:
+        return np.zeros(0, dtype=np.uint64)
+    hashes = np.zeros(count, dtype=np.uint64)
+    for j in range(window):
+        hashes = hashes * BASE + lines[j:j + count]
+    return hashes
+
+
+def directory_stamp(data_path):
+    """
+        Hash over names, sizes and modification times of all txt files in a
+        directory. Cached indexes of the corpus store it to detect changes.
+
+        PARAMETERS:
+        ---------------
+        data_path :     path to directory
+
+        RETURNS:
+        ---------------
+        hex string
+
+    """
+    stamp = hashlib.sha1()
+    for path, _, files in os.walk(data_path):
+        for file in sorted(files):
+            if file.endswith(".txt"):
+                info = os.stat(os.path.join(path, file))
+                stamp.update(f"{file}:{info.st_size}:{info.st_mtime_ns};".encode())
+    return stamp.hexdigest()
+
+
+class Fingerprint_index:
+    def __init__(self, window=WINDOW, shingle=SHINGLE, num_permutations=NUM_PERMUTATIONS):
+        self.window = window
+        self.shingle = shingle
+        self.hashes = np.zeros(0, dtype=np.uint64)
+        self.chorales = np.zeros(0, dtype=np.int32)
+        self.positions = np.zeros(0, dtype=np.int32)
+        self.names = []
+        self.stamp = ""
+        self.signatures = np.zeros((0, num_permutations), dtype=np.uint64)
+        rng = np.random.default_rng(0)
+        self.a = rng.integers(1, 2**63, num_permutations, dtype=np.uint64) | np.uint64(1)
+        self.b = rng.integers(0, 2**63, num_permutations, dtype=np.uint64)
+
+
+    def build(self, data_path=PATH_TO_CHORALES):
+        """
+            Fingerprints all chorales in a directory.
+
+            PARAMETERS:
+            ---------------
+            data_path :     path to the encoded chorales
+
+        """
+        self.stamp = directory_stamp(data_path)
+        self.names, pieces = load_directory(data_path)
+        hashes, chorales, positions, signatures = [], [], [], []
+        for i, piece in enumerate(pieces):
+            lines = pack_lines(parse_piece(piece))
+            piece_hashes = rolling_hashes(lines, self.window)
+            hashes.append(piece_hashes)
+            chorales.append(np.full(len(piece_hashes), i, dtype=np.int32))
+            positions.append(np.arange(len(piece_hashes), dtype=np.int32))
+            signatures.append(self.signature(lines))
+
+        hashes = np.concatenate(hashes)
+        order = np.argsort(hashes, kind="stable")
+        self.hashes = hashes[order]
+        self.chorales = np.concatenate(chorales)[order]
+        self.positions = np.concatenate(positions)[order]
+        self.signatures = np.array(signatures, dtype=np.uint64).reshape(len(pieces), -1)
+        return self
+
+
+    def save(self, path=INDEX_PATH):
+        np.savez(path, hashes=self.hashes, chorales=self.chorales, positions=self.positions,
+                 names=np.array(self.names), signatures=self.signatures, a=self.a, b=self.b,
+                 sizes=np.array([self.window, self.shingle]), stamp=np.array(self.stamp))
+
+
+    def load(self, path=INDEX_PATH):
+        data = np.load(path)
+        self.hashes, self.chorales, self.positions = data["hashes"], data["chorales"], data["positions"]
+        self.names = data["names"].tolist()
+        self.signatures, self.a, self.b = data["signatures"], data["a"], data["b"]
+        self.window, self.shingle = data["sizes"].tolist()
+        self.stamp = str(data["stamp"]) if "stamp" in data.files else ""
+        return self
+
+
+    def signature(self, lines):
+        """
+            MinHash signature of the set of shingles (short windows) of a piece.
+
+            PARAMETERS:
+            ---------------
+            lines :     np.array of packed lines
+
+            RETURNS:
+            ---------------
+            np.array of NUM_PERMUTATIONS uint64 values
+
+        """
+        shingles = np.unique(rolling_hashes(lines, self.shingle))
+        if len(shingles) == 0:
+            return np.full(len(self.a), np.iinfo(np.uint64).max, dtype=np.uint64)
+        return (shingles[:, None] * self.a + self.b).min(axis=0)
+
+
+    def find_copies(self, piece, ignore_lines=0):
+        """
+            Finds the regions of a piece which are copied from the corpus. A region is
+            reported if at least one window of self.window lines occurs in a chorale.
+            Overlapping windows copied from the same place are merged.
+
+            PARAMETERS:
+            ---------------
+            piece :             string representation of the piece
+            ignore_lines :      number of raw lines at the beginning to skip, e.g. the seed
+
+            RETURNS:
+            ---------------
+            list of dicts with the keys "start" and "end" (raw lines of the piece, end
+            exclusive), "chorale" (file name) and "source_start" (line in the chorale)
+
+        """
+        # parse_piece drops lines without four symbols, map back to the raw lines
+        raw = np.flatnonzero([len(line.split()) == 4 for line in piece.split("\n")])
+        skip = int(np.searchsorted(raw, ignore_lines))
+        lines = pack_lines(parse_piece(piece))[skip:]
+        hashes = rolling_hashes(lines, self.window)
+        found = np.searchsorted(self.hashes, hashes)
+        found[found == len(self.hashes)] = 0
+        matched = np.flatnonzero(self.hashes[found] == hashes) if len(self.hashes) else np.zeros(0, dtype=int)
+
+        regions = []
+        for start in matched + skip:
+            chorale, source = self.chorales[found[start - skip]], self.positions[found[start - skip]]
+            last = regions[-1] if regions else None
+            if (last is not None and last["chorale"] == chorale and start <= last["end"]
+                    and source - last["source_start"] == start - last["start"]):
+                last["end"] = start + self.window
+                continue
+            regions.append({"start": start, "end": start + self.window, "chorale": chorale, "source_start": source})
+        return [{"start": int(raw[region["start"]]), "end": int(raw[region["end"] - 1]) + 1,
+                 "chorale": self.names[region["chorale"]], "source_start": int(region["source_start"])}
+                for region in regions]
+
+
+    def similar_chorales(self, piece, threshold=0.5):
+        """
+            Estimates the Jaccard similarity between the shingles of a piece and
+            every chorale of the corpus with MinHash.
+
+            PARAMETERS:
+            ---------------
+            piece :         string representation of the piece
+            threshold :     minimal estimated similarity
+
+            RETURNS:
+            ---------------
+            list of (chorale, similarity) tuples, most similar first
+
+        """
+        signature = self.signature(pack_lines(parse_piece(piece)))
+        similarity = (self.signatures == signature).mean(axis=1)
+        candidates = np.flatnonzero(similarity >= threshold)
+        candidates = candidates[np.argsort(-similarity[candidates], kind="stable")]
+        return [(self.names[i], float(similarity[i])) for i in candidates]
+
+
+def get_index():
+    """
+        Returns the fingerprint index of the corpus. It is loaded from INDEX_PATH if
+        that was built from the current corpus, otherwise it is built and saved.
+        Safe to call from several threads.
+
+    """
+    global _INDEX
+    with _INDEX_LOCK:
+        if _INDEX is None:
+            stamp = directory_stamp(PATH_TO_CHORALES)
+            if os.path.exists(INDEX_PATH):
+                _INDEX = Fingerprint_index().load(INDEX_PATH)
+            if _INDEX is None or _INDEX.stamp != stamp:
+                _INDEX = Fingerprint_index().build()
+                _INDEX.save(INDEX_PATH)
+    return _INDEX
+
+
+if __name__=="__main__":
+    print("Building fingerprint index")
+    Fingerprint_index().build().save(INDEX_PATH)
+    print("Finished")
@@ -0,0 +1,405 @@
+"""
+    This module labels the chords of the encoded chorales and stores a per-bar
+    chord/cadence index of the whole corpus, so seeds with a given harmonic
+    content can be selected without parsing scores with music21.
+
+    Chords are labeled on every beat (4 steps of 16th notes) by matching the
+    sounding pitch classes of all four voices against major, minor and diminished
+    triad templates. Since every chorale is transposed to C major/A minor the
+    tonic is C or A, the mode is read off the last bass note. The labels are roman
+    numerals relative to the tonic:
+
+        major:  I bII II bIII III IV #IV V bVI VI bVII VII
+        minor:  I bII II III #III IV #IV V VI #VI VII #VII
+
+    Uppercase is a major, lowercase a minor and lowercase with "o" a diminished
+    triad, e.g. "I", "ii", "V", "viio" in major and "i", "iv", "V", "VI", "#viio"
+    in minor.
+
+    A bar ends on a cadence if its last chord starts on a strong beat (1 or 3)
+    and lasts at least two beats. A dominant followed by the tonic is no half
+    cadence. python harmony.py check compares the labels of some hand-checked
+    bars of the corpus.
+
+"""
+import numpy as np
+import os
+import sys
+import threading
+from numpy.lib.stride_tricks import sliding_window_view
+from evaluation import PATH_TO_CHORALES, load_directory, stack_pieces, sounding_pitches
+from fingerprint import directory_stamp
+
+STEPS_PER_BEAT = 4
+STEPS_PER_BAR = 16
+INDEX_PATH = "harmony_index.npz"
+INDEX_VERSION = 2               # increase when the labels change, cached indexes are rebuilt
+
+MAJOR, MINOR, DIMINISHED = 0, 1, 2
+MODES = ["major", "minor"]
+TRIADS = {MAJOR: (0, 4, 7), MINOR: (0, 3, 7), DIMINISHED: (0, 3, 6)}
+DEGREES = {
+    "major": ["I", "bII", "II", "bIII", "III", "IV", "#IV", "V", "bVI", "VI", "bVII", "VII"],
+    "minor": ["I", "bII", "II", "III", "#III", "IV", "#IV", "V", "VI", "#VI", "VII", "#VII"],
+}
+CADENCES = ["none", "authentic", "half", "plagal", "deceptive"]
+CADENCE_LENGTH = 2              # beats the final chord of a cadence lasts at least
+NO_CHORD = -1
+SEPARATOR = -2
+CHECKED_BARS = [("0.txt", 1, "none"),           # III V i V, the dominant resolves to VI
+                ("0.txt", 8, "authentic"),      # cadential 6-4, V7, i
+                ("101.txt", 3, "authentic"),    # IV V7 I
+                ("164.txt", 7, "half"),         # II V and a rest
+                ("180.txt", 7, "deceptive"),    # iv V VI
+                ("289.txt", 1, "plagal")]       # IV I
+
+_INDEX = None
+_INDEX_LOCK = threading.Lock()
+
+
+def chord_templates():
+    """
+        Weights of the 36 triads (12 roots times major/minor/diminished) over the
+        12 pitch classes: +1 for chord tones and -1 for all other pitch classes.
+
+        RETURNS:
+        ---------------
+        np.array of shape (36, 12), row root * 3 + quality
+
+    """
+    templates = -np.ones((36, 12))
+    for root in range(12):
+        for quality, intervals in TRIADS.items():
+            templates[root * 3 + quality, [(root + i) % 12 for i in intervals]] = 1
+    return templates
+
+
+TEMPLATES = chord_templates()
+
+
+def label_chords(batch):
+    """
+        Labels the chord on every beat of a batch of pieces.
+
+        PARAMETERS:
+        ---------------
+        batch :     (N, T, 4) array as returned by stack_pieces
+
+        RETURNS:
+        ---------------
+        (N, number of beats) array of chords root * 3 + quality, NO_CHORD if nothing sounds
+
+    """
+    pitches = sounding_pitches(batch)[:, ::STEPS_PER_BEAT]
+    sounding = pitches >= 0
+    classes = (pitches[..., None] % 12 == np.arange(12)) & sounding[..., None]
+    counts = classes.sum(axis=2)
+    scores = counts @ TEMPLATES.T
+
+    # prefer the chord whose root is in the bass
+    bass = np.where(sounding[..., 3], pitches[..., 3] % 12, -1)
+    scores += 0.5 * (np.arange(36) // 3 == bass[..., None])
+
+    chords = scores.argmax(axis=-1)
+    chords[~sounding.any(axis=-1)] = NO_CHORD
+    return chords
+
+
+def numeral(chord, tonic, mode):
+    """
+        Name of a chord relative to the tonic, see the module docstring.
+
+    """
+    if chord < 0:
+        return ""
+    root, quality = divmod(int(chord), 3)
+    name = DEGREES[mode][(root - tonic) % 12]
+    degree = name.lstrip("b#")
+    accidental = name[:len(name) - len(degree)]
+    if quality == MAJOR:
+        return name
+    return accidental + degree.lower() + ("o" if quality == DIMINISHED else "")
+
+
+def numeral_id(name, mode):
+    """
+        Inverse of numeral: integer (degree * 3 + quality) of a roman numeral.
+
+    """
+    diminished = name.endswith("o")
+    name = name[:-1] if diminished else name
+    degree = name.lstrip("b#")
+    accidental = name[:len(name) - len(degree)]
+    quality = DIMINISHED if diminished else MINOR if degree.islower() else MAJOR
+    return DEGREES[mode].index(accidental + degree.upper()) * 3 + quality
+
+
+def relative(chords, tonic):
+    """
+        Converts chords (root * 3 + quality) into degrees (degree * 3 + quality).
+
+    """
+    return np.where(chords >= 0, ((chords // 3 - tonic) % 12) * 3 + chords % 3, chords)
+
+
+def cadence(penultimate, final, following=NO_CHORD):
+    """
+        Classifies the cadence formed by the last two chords of a bar (as degree * 3 +
+        quality). A dominant is only a half cadence if no tonic follows it.
+
+        PARAMETERS:
+        ---------------
+        penultimate :   chord before the final chord
+        final :         last chord of the bar, has to be metrically strong and long
+        following :     next chord after the bar, NO_CHORD at the end of the piece
+
+        RETURNS:
+        ---------------
+        index into CADENCES
+
+    """
+    dominant = 7 * 3 + MAJOR
+    if final == dominant:
+        return CADENCES.index("none" if following in (MAJOR, MINOR) else "half")
+    if final in (MAJOR, MINOR):
+        if penultimate == dominant:
+            return CADENCES.index("authentic")
+        if penultimate in (5 * 3 + MAJOR, 5 * 3 + MINOR):
+            return CADENCES.index("plagal")
+    if penultimate == dominant and final in (8 * 3 + MAJOR, 9 * 3 + MINOR):
+        return CADENCES.index("deceptive")
+    return CADENCES.index("none")
+
+
+def piece_modes(batch):
+    """
+        The tonic is C or A, the mode of a whole chorale is decided by its last bass
+        note. For excerpts of a chorale use Harmony_index.mode instead.
+
+        PARAMETERS:
+        ---------------
+        batch :     (N, T, 4) array as returned by stack_pieces
+
+        RETURNS:
+        ---------------
+        np.array of N indices into MODES
+
+    """
+    last = np.maximum((batch[:, :, 3] >= 0).cumsum(axis=1).argmax(axis=1), 0)
+    bass = batch[np.arange(len(batch)), last, 3] % 12
+    return (bass == 9).astype(np.int8)
+
+
+def index_stamp(data_path):
+    """
+        Stamp of an index built from data_path with the current labeling rules.
+
+    """
+    return f"{INDEX_VERSION}:{directory_stamp(data_path)}"
+
+
+class Harmony_index:
+    def __init__(self):
+        self.names = []
+        self.stamp = ""
+        self.modes = np.zeros(0, dtype=np.int8)
+        self.beats = np.zeros((0, 0), dtype=np.int16)
+        self.sequence = np.zeros(0, dtype=np.int16)
+        self.sequence_chorales = np.zeros(0, dtype=np.int32)
+        self.sequence_bars = np.zeros(0, dtype=np.int32)
+        self.bar_chorales = np.zeros(0, dtype=np.int32)
+        self.bar_numbers = np.zeros(0, dtype=np.int32)
+        self.bar_cadences = np.zeros(0, dtype=np.int8)
+
+
+    def build(self, data_path=PATH_TO_CHORALES):
+        """
+            Labels all chorales in a directory and builds the bar index.
+
+            PARAMETERS:
+            ---------------
+            data_path :     path to the encoded chorales
+
+        """
+        self.stamp = index_stamp(data_path)
+        self.names, pieces = load_directory(data_path)
+        batch = stack_pieces(pieces)
+        chords = label_chords(batch)
+
+        self.modes = piece_modes(batch)
+        tonics = np.where(self.modes == MODES.index("minor"), 9, 0)
+        self.beats = relative(chords, tonics[:, None]).astype(np.int16)
+
+        sequence, sequence_chorales, sequence_bars = [], [], []
+        bar_chorales, bar_numbers, bar_cadences = [], [], []
+        beats_per_bar = STEPS_PER_BAR // STEPS_PER_BEAT
+        for i, beats in enumerate(self.beats):
+            positions = np.flatnonzero(beats >= 0)
+            changes = positions[np.r_[True, np.diff(beats[positions]) != 0]] if len(positions) else positions
+            sequence.extend(beats[changes].tolist() + [SEPARATOR])
+            sequence_chorales.extend([i] * (len(changes) + 1))
+            sequence_bars.extend((changes // beats_per_bar).tolist() + [-1])
+
+            # a chord lasts until the next change or the end of the piece. Chorales with an
+            # upbeat are shifted against the bars, the strong beats (1 and 3) are the ones
+            # of the same parity as the last chord, which always falls on a strong beat
+            ends = np.r_[changes[1:], positions[-1] + 1] if len(positions) else positions
+            strong = changes[-1] % 2 if len(changes) else 0
+            for bar in range(int(np.ceil((positions[-1] + 1) / beats_per_bar)) if len(positions) else 0):
+                last = np.searchsorted(changes, (bar + 1) * beats_per_bar) - 1
+                start = changes[last] if last >= 0 else -1
+                kind = CADENCES.index("none")
+                if (start >= bar * beats_per_bar and start % 2 == strong
+                        and ends[last] - start >= CADENCE_LENGTH):
+                    penultimate = beats[changes[last - 1]] if last > 0 else NO_CHORD
+                    following = beats[changes[last + 1]] if last + 1 < len(changes) else NO_CHORD
+                    kind = cadence(penultimate, beats[start], following)
+                bar_chorales.append(i)
+                bar_numbers.append(bar)
+                bar_cadences.append(kind)
+
+        self.sequence = np.array(sequence, dtype=np.int16)
+        self.sequence_chorales = np.array(sequence_chorales, dtype=np.int32)
+        self.sequence_bars = np.array(sequence_bars, dtype=np.int32)
+        self.bar_chorales = np.array(bar_chorales, dtype=np.int32)
+        self.bar_numbers = np.array(bar_numbers, dtype=np.int32)
+        self.bar_cadences = np.array(bar_cadences, dtype=np.int8)
+        return self
+
+
+    def save(self, path=INDEX_PATH):
+        np.savez(path, names=np.array(self.names), modes=self.modes, beats=self.beats,
+                 sequence=self.sequence, sequence_chorales=self.sequence_chorales,
+                 sequence_bars=self.sequence_bars, bar_chorales=self.bar_chorales,
+                 bar_numbers=self.bar_numbers, bar_cadences=self.bar_cadences, stamp=np.array(self.stamp))
+
+
+    def load(self, path=INDEX_PATH):
+        data = np.load(path)
+        for key in data.files:
+            setattr(self, key, data[key])
+        self.names = data["names"].tolist()
+        self.stamp = str(data["stamp"]) if "stamp" in data.files else ""
+        return self
+
+
+    def find_progression(self, numerals, mode=None, opening=False, bars=None):
+        """
+            Finds a chord progression, e.g. ["i", "V", "i"]. Repeated chords are
+            ignored, so the progression has to be given without repetitions.
+
+            PARAMETERS:
+            ---------------
+            numerals :      list of roman numerals
+            mode :          "major", "minor" or None for both
+            opening :       only match the first chords of a chorale
+            bars :          number of bars the progression has to fit in, e.g. the
+                            length of a seed starting at the returned bar, None for any
+
+            RETURNS:
+            ---------------
+            list of (chorale, bar) tuples where the progression starts
+
+        """
+        results = []
+        for current in MODES if mode is None else [mode]:
+            pattern = np.array([numeral_id(name, current) for name in numerals], dtype=np.int16)
+            if len(self.sequence) < len(pattern):
+                continue
+            windows = sliding_window_view(self.sequence, len(pattern))
+            starts = np.flatnonzero((windows == pattern).all(axis=1))
+            chorales = self.sequence_chorales[starts]
+            starts = starts[self.modes[chorales] == MODES.index(current)]
+            if opening:
+                starts = starts[(starts == 0) | (self.sequence[starts - 1] == SEPARATOR)]
+            if bars is not None:
+                starts = starts[self.sequence_bars[starts + len(pattern) - 1] - self.sequence_bars[starts] < bars]
+            results.extend(zip(self.sequence_chorales[starts].tolist(), self.sequence_bars[starts].tolist()))
+        return [(self.names[chorale], bar) for chorale, bar in sorted(results)]
+
+
+    def find_cadences(self, kind, mode=None):
+        """
+            Finds all bars which end on a cadence.
+
+            PARAMETERS:
+            ---------------
+            kind :      one of CADENCES, e.g. "half"
+            mode :      "major", "minor" or None for both
+
+            RETURNS:
+            ---------------
+            list of (chorale, bar) tuples
+
+        """
+        mask = self.bar_cadences == CADENCES.index(kind)
+        if mode is not None:
+            mask &= self.modes[self.bar_chorales] == MODES.index(mode)
+        bars = np.flatnonzero(mask)
+        return [(self.names[chorale], bar) for chorale, bar
+                in zip(self.bar_chorales[bars].tolist(), self.bar_numbers[bars].tolist())]
+
+
+    def mode(self, chorale):
+        """
+            Mode ("major" or "minor") of a chorale of the corpus, given by file name.
+
+        """
+        return MODES[self.modes[self.names.index(chorale)]]
+
+
+    def bar_chords(self, chorale, bar):
+        """
+            Roman numerals of the beats of one bar.
+
+            PARAMETERS:
+            ---------------
+            chorale :   file name of the chorale
+            bar :       number of the bar, starting at 0
+
+        """
+        i = self.names.index(chorale)
+        beats_per_bar = STEPS_PER_BAR // STEPS_PER_BEAT
+        beats = self.beats[i, bar * beats_per_bar:(bar + 1) * beats_per_bar]
+        return [numeral(beat, 0, MODES[self.modes[i]]) for beat in beats]
+
+
+def get_index():
+    """
+        Returns the harmony index of the corpus. It is loaded from INDEX_PATH if
+        that was built from the current corpus, otherwise it is built and saved.
+        Safe to call from several threads.
+
+    """
+    global _INDEX
+    with _INDEX_LOCK:
+        if _INDEX is None:
+            stamp = index_stamp(PATH_TO_CHORALES)
+            if os.path.exists(INDEX_PATH):
+                _INDEX = Harmony_index().load(INDEX_PATH)
+            if _INDEX is None or _INDEX.stamp != stamp:
+                _INDEX = Harmony_index().build()
+                _INDEX.save(INDEX_PATH)
+    return _INDEX
+
+
+def check():
+    """
+        Compares the cadences of the index with CHECKED_BARS. Raises AssertionError
+        if a label is wrong.
+
+    """
+    index = Harmony_index().build()
+    for name, bar, kind in CHECKED_BARS:
+        found = index.bar_cadences[(index.bar_chorales == index.names.index(name)) & (index.bar_numbers == bar)]
+        assert CADENCES[found[0]] == kind, f"{name} bar {bar}: {CADENCES[found[0]]} instead of {kind}"
+    print("All checks passed")
+
+
+if __name__=="__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "check":
+        check()
+    else:
+        print("Building harmony index")
+        Harmony_index().build().save(INDEX_PATH)
+        print("Finished")
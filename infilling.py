@@ -0,0 +1,285 @@
+"""
+    This module generates a chorale bar by bar in parallel instead of one completion
+    after another. The piece is planned as bar slots:
+
+        * the seed bars are kept as they are
+        * planning pass: the first line of every bar is generated in order with
+          one short call per bar. The prompt is the opening bar of the seed and an
+          outline of the bars before, i.e. the seed bars followed by every planned
+          first line held for a whole bar. The prompt of the last bar additionally
+          contains a cadence template, a bar of the corpus in the mode of the seed
+          which ends on an authentic cadence
+        * filling pass: every bar is generated concurrently from the same prompt
+          and its own first line. Several candidates are generated per bar and the
+          one leading best into the first line of the next bar is kept. For the last
+          bar the candidate ending closest to the final chord of the cadence
+          template wins. The template is only conditioning and a target, it is
+          never copied into the output
+        * repair pass: the last beat before every bar boundary is regenerated with
+          the actual previous bars as prompt and kept if the join into the next bar
+          has less parallels, crossings and large leaps
+
+    The wall-clock time of the filling and repair passes grows with the number of
+    bars divided by the parallelism instead of with the total number of completions.
+
+"""
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from random import choice
+from evaluation import load_directory, stack_pieces, evaluate_batch, sounding_pitches, symbol_to_midi, REST
+import fingerprint
+import harmony
+
+STEPS_PER_BAR = 16
+STEPS_PER_BEAT = 4
+MAX_CALLS_PER_BAR = 16
+CANDIDATES = 2                  # generated versions of every bar
+SEEN_LINES = 64
+HOLD_LINE = "_ _ _ _"
+
+_CORPUS = None
+
+
+def corpus_bars():
+    """
+        All chorales of the corpus as dict file name -> list of bars (lists of lines).
+
+    """
+    global _CORPUS
+    if _CORPUS is None:
+        names, pieces = load_directory(harmony.PATH_TO_CHORALES)
+        _CORPUS = {}
+        for name, piece in zip(names, pieces):
+            lines = complete_lines(piece)
+            _CORPUS[name] = [lines[i:i + STEPS_PER_BAR] for i in range(0, len(lines) - STEPS_PER_BAR + 1, STEPS_PER_BAR)]
+    return _CORPUS
+
+
+def complete_lines(text):
+    """
+        Lines of a piece with exactly four symbols, normalized to single spaces.
+
+    """
+    return [" ".join(line.split()) for line in text.split("\n") if len(line.split()) == 4]
+
+
+def valid_lines(text):
+    """
+        Finished lines of a completion up to the first line which is no valid step.
+        The text after the last line break may be cut off and is ignored, empty
+        lines are skipped.
+
+    """
+    lines = []
+    for line in text.rpartition("\n")[0].split("\n"):
+        symbols = line.split()
+        if not symbols:
+            continue
+        if len(symbols) != 4 or any(symbol != "r" and symbol_to_midi(symbol) == REST for symbol in symbols):
+            break
+        lines.append(" ".join(symbols))
+    return lines
+
+
+def continue_lines(prompt, complete, count, max_calls=MAX_CALLS_PER_BAR):
+    """
+        Calls the model until count valid lines follow the prompt. Invalid output is
+        dropped and the next call continues after the last valid line.
+
+        PARAMETERS:
+        ---------------
+        prompt :        string representation of the context, ending with a line break
+        complete :      function prompt -> completion text
+        count :         number of lines
+        max_calls :     upper bound of model calls
+
+        RETURNS:
+        ---------------
+        list of at most count lines
+
+    """
+    lines = []
+    for _ in range(max_calls):
+        if len(lines) >= count:
+            break
+        context = (prompt + "".join(line + "\n" for line in lines)).split("\n")[-SEEN_LINES - 1:]
+        lines += valid_lines(complete("\n".join(context)))
+    return lines[:count]
+
+
+def seed_mode(seed):
+    """
+        Mode of the chorale the seed is taken from. Seeds which are not taken from
+        the corpus are treated like a whole chorale, see harmony.piece_modes.
+
+    """
+    copies = fingerprint.get_index().find_copies(seed)
+    if copies:
+        return harmony.get_index().mode(copies[0]["chorale"])
+    return harmony.MODES[harmony.piece_modes(stack_pieces([seed]))[0]]
+
+
+def cadence_template(mode):
+    """
+        A bar of the corpus which ends on an authentic cadence in the given mode.
+
+    """
+    bars = corpus_bars()
+    candidates = [(name, bar) for name, bar in harmony.get_index().find_cadences("authentic", mode)
+                  if bar < len(bars.get(name, []))]
+    name, bar = choice(candidates)
+    return bars[name][bar]
+
+
+def last_pitches(snippets):
+    """
+        Sounding MIDI pitches of the four voices at the end of every snippet, -1 for rests.
+
+    """
+    return sounding_pitches(stack_pieces(["\n".join(lines) for lines in snippets]))[:, -1]
+
+
+def boundary_costs(snippets):
+    """
+        Voice-leading cost of short snippets around a bar boundary: parallel fifths
+        and octaves, voice crossings and melodic leaps larger than a fifth.
+
+        PARAMETERS:
+        ---------------
+        snippets :      list of lists of lines
+
+        RETURNS:
+        ---------------
+        np.array with one cost per snippet
+
+    """
+    batch = stack_pieces(["\n".join(lines) for lines in snippets])
+    metrics = evaluate_batch(batch)
+    pitches = sounding_pitches(batch)
+    moves = np.abs(np.diff(pitches, axis=1))
+    sounding = (pitches[:, 1:] >= 0) & (pitches[:, :-1] >= 0)
+    leaps = np.where(sounding & (moves > 7), moves - 7, 0).sum(axis=(1, 2))
+    return 10 * (metrics["parallel_fifths"] + metrics["parallel_octaves"]) + 5 * metrics["voice_crossings"] + leaps
+
+
+def target_costs(snippets, target):
+    """
+        Distance between the last chord of every snippet and the target line, in
+        semitones summed over the voices. Rests cost an octave.
+
+    """
+    ends = last_pitches(snippets)
+    goal = last_pitches([[target]])[0]
+    return np.where((ends >= 0) & (goal >= 0), np.abs(ends - goal), 12).sum(axis=1)
+
+
+def outline_prompt(head, outline):
+    """
+        Prompt of a bar slot: the head (opening and conditioning bars) followed by
+        as many of the outline lines before the slot as fit into SEEN_LINES together
+        with the bar, so the head is still seen while the bar is generated.
+
+    """
+    tail = outline[len(outline) - max(SEEN_LINES - len(head) - STEPS_PER_BAR, 0):]
+    return "\n".join(head + tail) + "\n"
+
+
+def plan_first_line(prompt, complete):
+    """
+        First line of a bar following the prompt, a hold line if the model fails.
+
+    """
+    lines = continue_lines(prompt, complete, 1, max_calls=2)
+    return lines[0] if lines else HOLD_LINE
+
+
+def fill_bar(prompt, first_line, complete):
+    """
+        Generates the rest of a bar after its planned first line.
+
+        RETURNS:
+        ---------------
+        list of STEPS_PER_BAR lines, missing lines are filled with holds
+
+    """
+    lines = continue_lines(prompt + first_line + "\n", complete, STEPS_PER_BAR - 1)
+    return ([first_line] + lines + [HOLD_LINE] * STEPS_PER_BAR)[:STEPS_PER_BAR]
+
+
+def repair_boundary(piece_bars, k, complete):
+    """
+        Regenerates the last beat of bar k - 1 and keeps the version which leads
+        better into the first line of bar k.
+
+        RETURNS:
+        ---------------
+        list of STEPS_PER_BEAT lines for the end of bar k - 1
+
+    """
+    before = [line for lines in piece_bars[:k] for line in lines][:-STEPS_PER_BEAT]
+    original = piece_bars[k - 1][-STEPS_PER_BEAT:]
+    prompt = "\n".join(before[-SEEN_LINES:]) + "\n"
+    candidate = continue_lines(prompt, complete, STEPS_PER_BEAT, max_calls=4)
+    if len(candidate) < STEPS_PER_BEAT:
+        return original
+    following = piece_bars[k][:1]
+    costs = boundary_costs([before[-1:] + original + following, before[-1:] + candidate + following])
+    return candidate if costs[1] < costs[0] else original
+
+
+def infill(seed, bars, complete, parallelism=8, mode=None):
+    """
+        Generates a chorale of the given number of bars by generating the bar
+        slots in parallel, see module docstring.
+
+        PARAMETERS:
+        ---------------
+        seed :          string representation of the seed, only full bars are used
+        bars :          number of bars of the whole piece including seed and cadence
+        complete :      function prompt -> completion text, called from several threads
+        parallelism :   number of concurrent model calls
+        mode :          "major" or "minor", None to look it up with seed_mode
+
+        RETURNS:
+        ---------------
+        string representation of the piece
+
+    """
+    lines = complete_lines(seed)
+    seed_bars = [lines[i:i + STEPS_PER_BAR] for i in range(0, len(lines) - STEPS_PER_BAR + 1, STEPS_PER_BAR)]
+    if not seed_bars:
+        raise ValueError("The seed has to contain at least one full bar")
+    if bars <= len(seed_bars):
+        return "\n".join(line for lines in seed_bars[:bars] for line in lines)
+
+    template = cadence_template(mode or seed_mode("\n".join(lines)))
+    opening = seed_bars[0]
+    outline = [line for lines in seed_bars[1:] for line in lines]
+    slots = list(range(len(seed_bars), bars))
+    prompts, first_lines = [], []
+    for k in slots:
+        head = opening + template if k == bars - 1 else opening
+        prompts.append(outline_prompt(head, outline))
+        first_lines.append(plan_first_line(prompts[-1], complete))
+        outline += [first_lines[-1]] + [HOLD_LINE] * (STEPS_PER_BAR - 1)
+
+    with ThreadPoolExecutor(max_workers=parallelism) as executor:
+        jobs = [(prompt, first_line) for prompt, first_line in zip(prompts, first_lines) for _ in range(CANDIDATES)]
+        generated = list(executor.map(lambda job: fill_bar(job[0], job[1], complete), jobs))
+
+        # keep the candidate leading best into the next bar, the last bar aims at the cadence
+        piece_bars = list(seed_bars)
+        for i in range(len(slots)):
+            candidates = generated[i * CANDIDATES:(i + 1) * CANDIDATES]
+            if i + 1 < len(slots):
+                costs = boundary_costs([candidate[-STEPS_PER_BEAT:] + [first_lines[i + 1]] for candidate in candidates])
+            else:
+                costs = target_costs(candidates, template[-1])
+            piece_bars.append(candidates[int(np.argmin(costs))])
+
+        boundaries = range(len(seed_bars) + 1, len(piece_bars))
+        endings = list(executor.map(lambda k: repair_boundary(piece_bars, k, complete), boundaries))
+    for k, ending in zip(boundaries, endings):
+        piece_bars[k - 1] = piece_bars[k - 1][:-STEPS_PER_BEAT] + ending
+
+    return "\n".join(line for lines in piece_bars for line in lines)
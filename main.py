@@ -1,7 +1,9 @@
 import streamlit as st
 import base64
-from utils import Choral_data, Seed_data, first_n_bars, save_piece
+from utils import Choral_data, Seed_data, first_n_bars, save_piece, store_generated
 from prediction import auto_generate
+from fingerprint import get_index
+import harmony
 
 
 header = st.container()
@@ -23,8 +25,14 @@ with st.sidebar:
             ("GPT3", "GPT2")
             )
 
+        seed_type = st.sidebar.selectbox(
+            "Choose the seed",
+            ("Random", "Opening I-V-I in major", "Opening i-V-i in minor")
+            )
+
         pushed = st.button("Generate seed!")
         main = st.checkbox("Generate music!")
+        engrave = st.checkbox("Engrave score as PDF")
 
 
 if radio =="Home":
@@ -125,25 +133,40 @@ elif radio == "Music Generation":
         
         if pushed:
             seed = Seed_data()
-            seed.load_seed()
+            if seed_type == "Opening I-V-I in major":
+                seed.load_seed(harmony.get_index().find_progression(["I", "V", "I"], mode="major", opening=True,
+                                                                    bars=1))
+            elif seed_type == "Opening i-V-i in minor":
+                seed.load_seed(harmony.get_index().find_progression(["i", "V", "i"], mode="minor", opening=True,
+                                                                    bars=1))
+            else:
+                seed.load_seed()
+            seed.to_svg()
             seed.create_mp3()
             print("---------hello--------")
             print(seed.path_mp3)
             with open(seed.path_mp3, "rb") as fp:
                 audio_bytes = fp.read()
             st.audio(audio_bytes, format="mp3")
-            seed.to_pdf()
+            if engrave:
+                seed.to_pdf()
             if main:
                 print("----in the main-------")
                 input = first_n_bars(seed.choral, 1)
                 output = auto_generate(input, 64)
                 print(output)
+                store_generated(output)
+                for copy in get_index().find_copies(output, ignore_lines=len(input.split("\n"))):
+                    st.warning(f"Lines {copy['start']}-{copy['end']} are copied from chorale "
+                               f"{copy['chorale']} (line {copy['source_start']})")
                 choral_data = Choral_data(output)
+                choral_data.to_svg()
                 choral_data.create_mp3()
                 with open(choral_data.path_mp3, "rb") as fp:
                     audio_bytes = fp.read()
                 st.audio(audio_bytes, format="mp3")
-                choral_data.to_pdf()
+                if engrave:
+                    choral_data.to_pdf()
 
 
 
@@ -1,6 +1,7 @@
 #import openai
 import os
 from utils import save_piece
+from infilling import infill
 
 # new
 from openai import OpenAI
@@ -55,6 +56,20 @@ def auto_generate(prompt, steps, seen_lines=64):
     return prompt
 
 
+def parallel_generate(prompt, bars=16, parallelism=8, temperature=0.6, mode=None):
+    """
+        Generates a piece of the given number of bars with concurrent model calls
+        per bar instead of one call after another, see infilling.py. mode is the
+        mode of the seed if the caller knows it.
+
+    """
+    def complete(pred_prompt):
+        output = client.completions.create(model=FINE_TUNED_MODEL, prompt=pred_prompt, temperature=temperature)
+        return output.choices[0].text
+
+    return infill(prompt, bars, complete, parallelism, mode)
+
+
 
 
 if __name__=="__main__":
@@ -0,0 +1,435 @@
+"""
+    This module exposes seed generation, generation and rendering as a small asyncio
+    HTTP service, so the model can be used by other services and load tests without
+    the streamlit page:
+
+        GET  /seed                  seed as text, optional query opening=I-V-I&mode=major
+                                    or cadence=half (see harmony.py)
+        POST /generate              body {"prompt": ..., "steps": 64, "temperature": 0.6,
+                                    "stream": false}, returns the piece as text. With
+                                    "stream": true every completion is sent as soon as
+                                    it arrives (chunked transfer encoding). With
+                                    "bars": 16 the bars are generated in parallel
+                                    by at most "parallelism" (default 8) threads,
+                                    "mode": "minor" sets the mode of the seed,
+                                    see infilling.py
+        POST /render?format=midi    body is the piece, returns MIDI, mp3 or svg bytes
+
+    All requests to the completions API share one connection pooled client. The
+    number of concurrent generate/render requests is limited and so is the number
+    of completions in flight, which is never larger than the pool, because one
+    parallel generate request alone makes up to "parallelism" calls at a time.
+
+    For tests the service can run against a local stub of the completions API which
+    answers with bars of the corpus:
+
+        python service.py stub 8001
+        UPSTREAM_URL=http://127.0.0.1:8001/v1 API_KEY=stub python service.py serve 8000
+
+    python service.py check runs both in one process and tests every endpoint.
+
+"""
+import asyncio
+import httpx
+import json
+import os
+import sys
+import tempfile
+from random import choice
+from types import SimpleNamespace
+from urllib.parse import urlsplit, parse_qs
+from openai import AsyncOpenAI
+from utils import Seed_data, piece_to_midi_bytes, piece_to_svg, PATH_TO_CHORALES
+from infilling import infill
+import harmony
+
+FINE_TUNED_MODEL = "curie:ft-personal-2022-07-17-00-27-00"
+UPSTREAM_URL = os.environ.get("UPSTREAM_URL")
+HOST = "127.0.0.1"
+PORT = 8000
+MAX_CONCURRENT = 8              # generate/render requests handled at the same time
+MAX_CONNECTIONS = 16            # pooled connections to the completions API
+SEEN_LINES = 64
+MAX_STEPS = 256
+MAX_BARS = 32
+MAX_PARALLELISM = 8
+MAX_BODY = 1 << 20
+
+STATUS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed",
+          413: "Payload Too Large", 500: "Internal Server Error"}
+CONTENT_TYPES = {"midi": "audio/midi", "mp3": "audio/mpeg", "svg": "image/svg+xml"}
+
+
+class Http_error(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+class Request:
+    def __init__(self, method, target, headers, body):
+        url = urlsplit(target)
+        self.method = method
+        self.path = url.path
+        self.query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        self.headers = headers
+        self.body = body
+
+    def json(self):
+        try:
+            return json.loads(self.body or b"{}")
+        except ValueError:
+            raise Http_error(400, "Body is no valid json")
+
+
+class Http_server:
+    """
+        Minimal HTTP/1.1 server on top of asyncio streams. Handlers are coroutines
+        which get a Request and return (content type, bytes) or (content type, async
+        iterator of bytes) for chunked responses. Connections are kept alive, but
+        closed after every error response. If a chunked response fails after the
+        headers are sent the connection is aborted.
+
+    """
+    def __init__(self):
+        self.routes = {}
+
+    def route(self, method, path, handler):
+        self.routes[(method, path)] = handler
+
+    async def read_request(self, reader):
+        line = await reader.readline()
+        if not line:
+            return None
+        try:
+            method, target, _ = line.decode("latin-1").split()
+        except ValueError:
+            raise Http_error(400, "Malformed request line")
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            key, _, value = line.decode("latin-1").partition(":")
+            headers[key.strip().lower()] = value.strip()
+        length = headers.get("content-length", "0")
+        if not (length.isascii() and length.isdigit()):
+            raise Http_error(400, "Invalid Content-Length")
+        length = int(length)
+        if length > MAX_BODY:
+            raise Http_error(413, "Body too large")
+        body = await reader.readexactly(length) if length else b""
+        return Request(method, target, headers, body)
+
+    async def respond(self, writer, status, content_type, body):
+        head = f"HTTP/1.1 {status} {STATUS[status]}\r\nContent-Type: {content_type}\r\n"
+        if status != 200:
+            head += "Connection: close\r\n"
+        if isinstance(body, (bytes, bytearray)):
+            writer.write(f"{head}Content-Length: {len(body)}\r\n\r\n".encode() + body)
+        else:
+            writer.write(f"{head}Transfer-Encoding: chunked\r\n\r\n".encode())
+            try:
+                async for chunk in body:
+                    if chunk:
+                        writer.write(f"{len(chunk):x}\r\n".encode() + chunk + b"\r\n")
+                        await writer.drain()
+            except Exception as e:
+                # the status line is already sent, the client can only see the broken body
+                print("Strange exception occured")
+                print(e)
+                writer.transport.abort()
+                raise ConnectionAbortedError(str(e))
+            writer.write(b"0\r\n\r\n")
+        await writer.drain()
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                request = None
+                try:
+                    request = await self.read_request(reader)
+                    if request is None:
+                        break
+                    handler = self.routes.get((request.method, request.path))
+                    if handler is None:
+                        allowed = any(path == request.path for _, path in self.routes)
+                        raise Http_error(405 if allowed else 404, f"No route for {request.method} {request.path}")
+                    content_type, body = await handler(request)
+                    await self.respond(writer, 200, content_type, body)
+                except Http_error as e:
+                    # the rest of the request may be unread, so never reuse the connection
+                    await self.respond(writer, e.status, "text/plain", str(e).encode())
+                    break
+                except (asyncio.IncompleteReadError, ConnectionError):
+                    break
+                except Exception as e:
+                    print("Strange exception occured")
+                    print(e)
+                    await self.respond(writer, 500, "text/plain", str(e).encode())
+                    break
+                if request.headers.get("connection", "").lower() == "close":
+                    break
+        finally:
+            writer.close()
+
+    async def serve(self, host, port):
+        server = await asyncio.start_server(self.handle, host, port)
+        print(f"Serving on http://{host}:{port}")
+        async with server:
+            await server.serve_forever()
+
+
+class Service(Http_server):
+    def __init__(self, client=None, max_concurrent=MAX_CONCURRENT):
+        super().__init__()
+        if client is None:
+            http_client = httpx.AsyncClient(
+                limits=httpx.Limits(max_connections=MAX_CONNECTIONS, max_keepalive_connections=MAX_CONNECTIONS),
+                timeout=httpx.Timeout(60.0))
+            client = AsyncOpenAI(api_key=os.environ.get("API_KEY"), base_url=UPSTREAM_URL, http_client=http_client)
+        self.client = client
+        self.limit = asyncio.Semaphore(max_concurrent)
+        self.upstream = asyncio.Semaphore(MAX_CONNECTIONS)
+        self.route("GET", "/seed", self.seed)
+        self.route("POST", "/generate", self.generate)
+        self.route("POST", "/render", self.render)
+
+    async def seed(self, request):
+        candidates = None
+        if request.query.get("mode", "major") not in harmony.MODES:
+            raise Http_error(400, f"Unknown mode, use one of {harmony.MODES}")
+        if "opening" in request.query:
+            numerals = request.query["opening"].split("-")
+            try:
+                # the seed is one bar long, the progression has to be complete in it
+                candidates = harmony.get_index().find_progression(numerals, request.query.get("mode"), opening=True,
+                                                                  bars=1)
+            except ValueError:
+                raise Http_error(400, f"Unknown roman numeral in {request.query['opening']}")
+        elif "cadence" in request.query:
+            if request.query["cadence"] not in harmony.CADENCES:
+                raise Http_error(400, f"Unknown cadence, use one of {harmony.CADENCES}")
+            candidates = harmony.get_index().find_cadences(request.query["cadence"], request.query.get("mode"))
+        if candidates is not None and not candidates:
+            raise Http_error(404, "No seed matches the query")
+        seed = Seed_data()
+        seed.load_seed(candidates)
+        return "text/plain", seed.choral.encode()
+
+    async def complete(self, prompt, temperature):
+        """
+            One call of the completions API, waits while MAX_CONNECTIONS calls are in flight.
+
+        """
+        async with self.upstream:
+            output = await self.client.completions.create(model=FINE_TUNED_MODEL, prompt=prompt,
+                                                          temperature=temperature)
+        return output.choices[0].text
+
+    async def completions(self, prompt, steps, temperature, seen_lines=SEEN_LINES):
+        """
+            Same as auto_generate from prediction, but asynchronous. Yields the
+            text of every completion.
+
+        """
+        for _ in range(steps):
+            pred_prompt = "\n".join(prompt.split("\n")[-seen_lines:])
+            text = await self.complete(pred_prompt, temperature)
+            prompt += text
+            yield text
+
+    async def generate(self, request):
+        parameters = request.json()
+        if not isinstance(parameters, dict):
+            raise Http_error(400, "Body has to be a json object")
+        try:
+            prompt = str(parameters.get("prompt", ""))
+            steps = int(parameters.get("steps", 64))
+            temperature = float(parameters.get("temperature", 0.6))
+            bars = int(parameters.get("bars", 0))
+            parallelism = int(parameters.get("parallelism", MAX_PARALLELISM))
+        except (TypeError, ValueError) as e:
+            raise Http_error(400, f"Invalid parameter: {e}")
+        if not 0 <= steps <= MAX_STEPS:
+            raise Http_error(400, f"steps has to be between 0 and {MAX_STEPS}")
+        if "bars" in parameters and not 1 <= bars <= MAX_BARS:
+            raise Http_error(400, f"bars has to be between 1 and {MAX_BARS}")
+        if not 1 <= parallelism <= MAX_PARALLELISM:
+            raise Http_error(400, f"parallelism has to be between 1 and {MAX_PARALLELISM}")
+        mode = parameters.get("mode")
+        if mode is not None and mode not in harmony.MODES:
+            raise Http_error(400, f"Unknown mode, use one of {harmony.MODES}")
+
+        if "bars" in parameters:
+            loop = asyncio.get_running_loop()
+
+            def complete(pred_prompt):
+                return asyncio.run_coroutine_threadsafe(self.complete(pred_prompt, temperature), loop).result()
+
+            async with self.limit:
+                try:
+                    piece = await loop.run_in_executor(None, infill, prompt, bars, complete, parallelism,
+                                                       mode)
+                except ValueError as e:
+                    raise Http_error(400, str(e))
+            return "text/plain", piece.encode()
+
+        if parameters.get("stream"):
+            async def chunks():
+                async with self.limit:
+                    yield prompt.encode()
+                    async for text in self.completions(prompt, steps, temperature):
+                        yield text.encode()
+            return "text/plain", chunks()
+
+        async with self.limit:
+            piece = prompt
+            async for text in self.completions(prompt, steps, temperature):
+                piece += text
+        return "text/plain", piece.encode()
+
+    async def render(self, request):
+        format = request.query.get("format", "midi")
+        if format not in CONTENT_TYPES:
+            raise Http_error(400, f"Unknown format, use one of {list(CONTENT_TYPES)}")
+        piece = request.body.decode()
+        loop = asyncio.get_running_loop()
+        async with self.limit:
+            if format == "svg":
+                return CONTENT_TYPES[format], piece_to_svg(piece).encode()
+            midi = await loop.run_in_executor(None, piece_to_midi_bytes, piece)
+            if format == "midi":
+                return CONTENT_TYPES[format], midi
+            return CONTENT_TYPES[format], await midi_to_mp3(midi)
+
+
+async def midi_to_mp3(midi):
+    """
+        Converts MIDI bytes into mp3 bytes with timidity and ffmpeg.
+
+    """
+    with tempfile.NamedTemporaryFile(suffix=".mid") as fp:
+        fp.write(midi)
+        fp.flush()
+        process = await asyncio.create_subprocess_shell(
+            f"timidity {fp.name} -Ow -o - | ffmpeg -i - -acodec libmp3lame -ab 64k -f mp3 -",
+            stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.DEVNULL)
+        mp3, _ = await process.communicate()
+    if process.returncode != 0:
+        raise Http_error(500, "Could not convert MIDI to mp3")
+    return mp3
+
+
+class Stub_backend(Http_server):
+    """
+        Local stand-in for the completions API. Every completion is one random
+        bar (16 lines) of the corpus.
+
+    """
+    def __init__(self, delay=0.0):
+        super().__init__()
+        self.delay = delay
+        self.bars = []
+        for file in os.listdir(PATH_TO_CHORALES):
+            with open(os.path.join(PATH_TO_CHORALES, file), "r") as fp:
+                lines = fp.read().split("\n")
+            self.bars.extend("\n".join(lines[i:i + 16]) for i in range(0, len(lines) - 15, 16))
+        self.route("POST", "/v1/completions", self.completions)
+
+    async def completions(self, request):
+        parameters = request.json()
+        await asyncio.sleep(self.delay)
+        text = "\n" + choice(self.bars)
+        return "application/json", json.dumps({
+            "id": "stub", "object": "text_completion", "created": 0, "model": parameters.get("model"),
+            "choices": [{"text": text, "index": 0, "logprobs": None, "finish_reason": "length"}],
+            "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0},
+        }).encode()
+
+
+class Failing_client:
+    """
+        Client for check() whose second completion fails.
+
+    """
+    def __init__(self):
+        self.completions = self
+        self.calls = 0
+
+    async def create(self, **kwargs):
+        self.calls += 1
+        if self.calls > 1:
+            raise RuntimeError("Upstream failed")
+        return SimpleNamespace(choices=[SimpleNamespace(text="\nC4 C4 C4 C4\n")])
+
+
+async def check():
+    """
+        Starts the stub backend and the service on free ports and sends requests
+        to every endpoint. Raises AssertionError if a response is wrong.
+
+    """
+    stub = await asyncio.start_server(Stub_backend().handle, HOST, 0)
+    upstream = AsyncOpenAI(api_key="stub", base_url=f"http://{HOST}:{stub.sockets[0].getsockname()[1]}/v1")
+    server = await asyncio.start_server(Service(upstream).handle, HOST, 0)
+    failing = await asyncio.start_server(Service(Failing_client()).handle, HOST, 0)
+    url = f"http://{HOST}:{server.sockets[0].getsockname()[1]}"
+    failing_url = f"http://{HOST}:{failing.sockets[0].getsockname()[1]}"
+    try:
+        async with httpx.AsyncClient(base_url=url, timeout=60) as client:
+            seed = await client.get("/seed")
+            assert seed.status_code == 200 and len(seed.text.split("\n")) == 17, seed.text
+
+            response = await client.post("/generate", json={"prompt": seed.text, "steps": 2})
+            assert response.status_code == 200 and response.text.startswith(seed.text), response.text
+
+            async with client.stream("POST", "/generate", json={"prompt": seed.text, "steps": 2, "stream": True}) as stream:
+                chunks = [chunk async for chunk in stream.aiter_bytes()]
+            assert b"".join(chunks).startswith(seed.text.encode()), chunks
+
+            response = await client.post("/render", params={"format": "midi"}, content=seed.text)
+            assert response.status_code == 200 and response.content.startswith(b"MThd"), response.content[:20]
+
+            response = await client.post("/generate", json={"prompt": seed.text, "bars": 3, "parallelism": 4,
+                                                            "mode": "major"})
+            assert response.status_code == 200 and len(response.text.split("\n")) == 48, response.text
+
+            for body in ({"steps": "x"}, [1, 2], {"bars": 0}, {"bars": 1000}, {"bars": 4, "parallelism": 64},
+                         {"bars": 4, "mode": "dorian"}):
+                response = await client.post("/generate", json=body)
+                assert response.status_code == 400, response.text
+            response = await client.get("/unknown")
+            assert response.status_code == 404 and response.headers["connection"] == "close", response.text
+
+        # httpx always sends a valid Content-Length, so this request is written by hand
+        reader, writer = await asyncio.open_connection(HOST, server.sockets[0].getsockname()[1])
+        writer.write(b"POST /generate HTTP/1.1\r\nContent-Length: -1\r\n\r\n")
+        status = await reader.readline()
+        writer.close()
+        assert status.startswith(b"HTTP/1.1 400"), status
+
+        # a failure after the headers of a chunked response are sent aborts the connection
+        async with httpx.AsyncClient(base_url=failing_url, timeout=60) as client:
+            try:
+                async with client.stream("POST", "/generate", json={"steps": 3, "stream": True}) as stream:
+                    body = b"".join([chunk async for chunk in stream.aiter_bytes()])
+                raise AssertionError(f"Broken stream was completed: {body}")
+            except httpx.RemoteProtocolError:
+                pass
+    finally:
+        await upstream.close()
+        for current in (stub, server, failing):
+            current.close()
+            await current.wait_closed()
+    print("All checks passed")
+
+
+if __name__=="__main__":
+    mode = sys.argv[1] if len(sys.argv) > 1 else "serve"
+    port = int(sys.argv[2]) if len(sys.argv) > 2 else PORT
+    if mode == "check":
+        asyncio.run(check())
+    else:
+        server = Stub_backend() if mode == "stub" else Service()
+        asyncio.run(server.serve(HOST, port))
@@ -3,11 +3,15 @@ import numpy as np
 import base64
 import os
 import subprocess
+import hashlib
 import streamlit as st
-from random import randint
+from random import choice
 from time import sleep
+from evaluation import parse_piece, HOLD, PATH_TO_GENERATED
 
 PATH_TO_CHORALES = "data_chorales_gpt3"
+PATH_TO_PDF_CACHE = "midi_results/pdf_cache"
+VOICE_COLORS = ["#d62728", "#1f77b4", "#2ca02c", "#9467bd"]
 
 
 class Seed_data:
@@ -20,7 +24,8 @@ class Seed_data:
         self.stream = None
     
     def gen_seed(self):
-        return randint(0, 367)
+        # not every number up to 367 is a chorale, only pick existing files
+        return int(choice([file[:-4] for file in os.listdir(PATH_TO_CHORALES) if file.endswith(".txt")]))
 
     def displayPDF(self, file):
         with open(file, "rb") as f:
@@ -29,15 +34,28 @@ class Seed_data:
         st.markdown(pdf_display, unsafe_allow_html=True)
 
 
-    def load_seed(self):
-        seed = self.gen_seed()
-        with open(os.path.join(PATH_TO_CHORALES, str(seed) + ".txt"), "r") as fp:
-            choral = fp.read().split("\n")[:17]
+    def load_seed(self, candidates=None):
+        """
+            Loads the first bar of a random chorale. If candidates are given, e.g. the
+            result of a query to the harmony index, the seed starts at one of these
+            (chorale, bar) positions.
+
+        """
+        if candidates:
+            file_name, bar = choice(candidates)
+        else:
+            file_name, bar = str(self.gen_seed()) + ".txt", 0
+        with open(os.path.join(PATH_TO_CHORALES, file_name), "r") as fp:
+            choral = fp.read().split("\n")[bar*16:bar*16 + 17]
             self.choral = "\n".join(choral)
-        self.path_pdf, self.stream = save_piece(self.choral, step_duration=0.25, format="musicxml.pdf", file_name="midi_results/seed.pdf")
-    
+
+
+    def to_svg(self):
+        st.markdown(piece_to_svg(self.choral), unsafe_allow_html=True)
+
 
     def to_pdf(self):
+        self.path_pdf = engrave_pdf(self.choral)
         self.displayPDF(self.path_pdf)
     
 
@@ -67,8 +85,12 @@ class Choral_data:
         st.markdown(pdf_display, unsafe_allow_html=True)
 
 
+    def to_svg(self):
+        st.markdown(piece_to_svg(self.choral), unsafe_allow_html=True)
+
+
     def to_pdf(self):
-        self.path_pdf, self.stream = save_piece(self.choral, step_duration=0.25, format="musicxml.pdf", file_name="midi_results/output.pdf")
+        self.path_pdf = engrave_pdf(self.choral)
         self.displayPDF(self.path_pdf)
     
 
@@ -103,16 +125,14 @@ def uniquify(path):
     return path
 
 
-def save_piece(piece, step_duration=0.25, format="midi", file_name="mel.mid"):
+def piece_to_stream(piece, step_duration=0.25):
     """
-        Converts a piece into a MIDI file
+        Converts a piece into a music21 stream with one part per voice
 
         PARAMETERS:
         ---------------
         piece :             string representation of the piece
         step_duration :     for 16th node use 0.25
-        format :            to which format do you want to convert the string representation, e.g. midi, musicxml
-        file_name :         name of file
 
     """
     splitted = [m.split() for m in piece.split("\n")]
@@ -159,7 +179,126 @@ def save_piece(piece, step_duration=0.25, format="midi", file_name="mel.mid"):
 
         stream.append(parts[j])
 
+    return stream
+
+
+def piece_to_midi_bytes(piece, step_duration=0.25):
+    """
+        Converts a piece into the bytes of a MIDI file without touching the disk
+
+        PARAMETERS:
+        ---------------
+        piece :             string representation of the piece
+        step_duration :     for 16th node use 0.25
+
+    """
+    return m21.midi.translate.streamToMidiFile(piece_to_stream(piece, step_duration)).writestr()
+
+
+def store_generated(piece, save_dir=PATH_TO_GENERATED):
+    """
+        Stores the text representation of a generated piece, e.g. for evaluation.py
+
+        PARAMETERS:
+        ---------------
+        piece :         string representation of the piece
+        save_dir :      directory (created only if not exists)
+
+    """
+    if not os.path.exists(save_dir):
+        os.makedirs(save_dir)
+    file_name = uniquify(os.path.join(save_dir, "generated.txt"))
+    with open(file_name, "w") as fp:
+        fp.write(piece)
+    return file_name
+
+
+def save_piece(piece, step_duration=0.25, format="midi", file_name="mel.mid"):
+    """
+        Converts a piece into a MIDI file
+
+        PARAMETERS:
+        ---------------
+        piece :             string representation of the piece
+        step_duration :     for 16th node use 0.25
+        format :            to which format do you want to convert the string representation, e.g. midi, musicxml
+        file_name :         name of file
+
+    """
+    stream = piece_to_stream(piece, step_duration)
     file_name = uniquify(file_name)
     stream.write(format, file_name)
 
-    return file_name, stream
\ No newline at end of file
+    return file_name, stream
+
+
+def piece_to_svg(piece, step_width=6, pitch_height=5, steps_per_bar=16):
+    """
+        Draws a piece as piano roll directly into an SVG string. This is much
+        faster than engraving the score with music21 and works without any
+        external notation program.
+
+        PARAMETERS:
+        ---------------
+        piece :             string representation of the piece
+        step_width :        width of one time step in pixels
+        pitch_height :      height of one semitone in pixels
+        steps_per_bar :     for 16th notes in 4/4 use 16
+
+        RETURNS:
+        ---------------
+        svg as string
+
+    """
+    grid = parse_piece(piece)
+    steps = len(grid)
+    sounding = grid[grid >= 0]
+    low, high = (int(sounding.min()), int(sounding.max())) if len(sounding) else (60, 72)
+    width = max(steps, 1) * step_width
+    height = (high - low + 1) * pitch_height
+
+    elements = []
+    for pitch in range(low, high + 1):
+        if pitch % 12 == 0:
+            y = (high - pitch) * pitch_height
+            elements.append(f'<rect x="0" y="{y}" width="{width}" height="{pitch_height}" fill="#eeeeee"/>')
+    for step in range(0, steps + 1, steps_per_bar):
+        elements.append(f'<line x1="{step * step_width}" y1="0" x2="{step * step_width}" y2="{height}" stroke="#999999"/>')
+
+    for voice in range(grid.shape[1]):
+        onsets = np.flatnonzero(grid[:, voice] != HOLD)
+        lengths = np.diff(np.append(onsets, steps))
+        pitches = grid[onsets, voice]
+        for start, length, pitch in zip(onsets[pitches >= 0], lengths[pitches >= 0], pitches[pitches >= 0]):
+            elements.append(f'<rect x="{start * step_width}" y="{(high - pitch) * pitch_height}" '
+                            f'width="{length * step_width - 1}" height="{pitch_height}" '
+                            f'fill="{VOICE_COLORS[voice % len(VOICE_COLORS)]}"/>')
+
+    return (f'<svg xmlns="http://www.w3.org/2000/svg" width="{width}" height="{height}" '
+            f'viewBox="0 0 {width} {height}">' + "".join(elements) + "</svg>")
+
+
+def engrave_pdf(piece, cache_dir=PATH_TO_PDF_CACHE):
+    """
+        Engraves a piece as PDF with music21. This is slow and needs an external
+        notation program, so it should only be called if the score is requested.
+        The result is cached by the content of the piece.
+
+        PARAMETERS:
+        ---------------
+        piece :         string representation of the piece
+        cache_dir :     directory of the cached PDFs
+
+        RETURNS:
+        ---------------
+        path to the PDF
+
+    """
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+    file_name = os.path.join(cache_dir, hashlib.sha1(piece.encode()).hexdigest() + ".pdf")
+    if not os.path.exists(file_name):
+        path, stream = save_piece(piece, step_duration=0.25, format="musicxml.pdf", file_name=file_name)
+        if path != file_name:
+            os.replace(path, file_name)
+    return file_name
\ No newline at end of file